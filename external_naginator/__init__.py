@@ -2,24 +2,32 @@
 Generate all the nagios configuration files based on puppetdb information.
 """
 import os
+import re
 import sys
 import grp
 import pdb
+import json
+import hashlib
 import stat
+import string
 import logging
 import configparser
 import filecmp
+import fnmatch
 import shutil
 import tempfile
 import subprocess
+import time
 import traceback
 from os import path
-from io import StringIO
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
 from contextlib import contextmanager
+from datetime import timedelta
 from functools import partial
 
 from pypuppetdb import connect
+from pypuppetdb.errors import APIError
+from requests.exceptions import RequestException
 
 LOG = logging.getLogger(__name__)
 
@@ -62,17 +70,65 @@ def nagios_config(config_dirs):
             shutil.rmtree(temp_dir)
 
 
-def nagios_verify(config_dirs, config_file=None):
+def nagios_precache_file(config_file):
+    """Return the precached_object_file set in a Nagios main config file."""
+    with open(config_file) as f:
+        for line in f:
+            name, _, value = line.strip().partition('=')
+            if name.strip() == 'precached_object_file' and value.strip():
+                return path.join(path.dirname(config_file), value.strip())
+    return None
+
+
+@contextmanager
+def nagios_precache_config(config_file, precache_file):
+    """
+    .. function:: nagios_precache_config(config_file, precache_file)
+
+    Copy the Nagios main config_file as a temporary file with
+    precached_object_file set to precache_file.  The copy is created
+    alongside config_file so relative paths within it still resolve.
+    Without a precache_file, config_file is used as it is.
+
+    :param config_file: the Nagios main config file
+    :type config_file: str
+    :param precache_file: where Nagios should write the precached objects
+    :type precache_file: str
+    :rtype: str
+    """
+    if not precache_file:
+        yield config_file
+        return
+
+    with open(config_file) as f:
+        config_lines = [line for line in f.read().splitlines()
+                        if line.partition('=')[0].strip() !=
+                        'precached_object_file']
+    config_lines.append("precached_object_file=%s" % precache_file)
+    with tempfile.NamedTemporaryFile(mode="w", suffix='.cfg',
+                                     dir=path.dirname(config_file)) as config:
+        set_permissions(config.name, stat.S_IRGRP)
+        config.write("\n".join(config_lines))
+        config.flush()
+        yield config.name
+
+
+def nagios_verify(config_dirs, config_file=None, precache_file=None):
 
     with nagios_config(config_dirs) as tmp_config_file:
         LOG.info("Validating Nagios config %s" % ', '.join(config_dirs))
-        p = subprocess.Popen(['/usr/sbin/nagios4', '-v',
-                              config_file or tmp_config_file],
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             encoding='utf8')
-        output, err = p.communicate()
+        command = ['/usr/sbin/nagios4', '-v']
+        if precache_file:
+            # Precache the objects while they are being verified.
+            command.append('-p')
+        with nagios_precache_config(config_file or tmp_config_file,
+                                    precache_file) as verify_config_file:
+            p = subprocess.Popen(command + [verify_config_file],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 encoding='utf8')
+            output, err = p.communicate()
         return_code = p.returncode
         for line in output.split('\n'):
             LOG.debug(line)
@@ -83,10 +139,10 @@ def nagios_verify(config_dirs, config_file=None):
             raise Exception("Nagios validation failed.")
 
 
-def nagios_restart():
-    """Restart Nagios"""
-    LOG.info("Restarting Nagios")
-    p = subprocess.Popen(['/usr/sbin/service', 'nagios4', 'restart'],
+def nagios_service(action, service='nagios4'):
+    """Run a Nagios service action, eg. restart"""
+    LOG.info("Running %s service %s" % (service, action))
+    p = subprocess.Popen(['/usr/sbin/service', service, action],
                          stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE,
@@ -95,7 +151,17 @@ def nagios_restart():
     return_code = p.returncode
     if return_code > 0:
         print(output)
-        raise Exception("Failed to restart Nagios.")
+        raise Exception("Failed to %s Nagios." % action)
+
+
+def nagios_restart(service='nagios4'):
+    """Restart Nagios"""
+    nagios_service('restart', service)
+
+
+def nagios_reload(service='nagios4'):
+    """Reload Nagios"""
+    nagios_service('reload', service)
 
 
 def nagios_gid():
@@ -108,20 +174,89 @@ def set_permissions(path, mode):
         os.chown(path, -1, nagios_gid())
 
 
+def reuse_config(config_dir, output_dir, patterns):
+    """
+    Replace the files in output_dir whose names match patterns with the
+    matching files from config_dir.
+    """
+    def matching(directory):
+        if not path.isdir(directory):
+            return []
+        return [f for f in os.listdir(directory)
+                if any(fnmatch.fnmatch(f, p) for p in patterns)]
+
+    for filename in matching(output_dir):
+        os.remove(path.join(output_dir, filename))
+    for filename in matching(config_dir):
+        shutil.copy(path.join(config_dir, filename),
+                    path.join(output_dir, filename))
+
+
+def share_deadline(deadline, share, shares_left):
+    """
+    Return the deadline of a part of the work that gets share of the
+    shares_left of the time left before deadline.
+    """
+    if deadline is None:
+        return None
+    now = time.monotonic()
+    return now + max(deadline - now, 0) * share / shares_left
+
+
+def batches(items, size=100):
+    """Split items into lists of at most size, to keep queries short."""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class NagiosObject(namedtuple('NagiosObject', ['type', 'name', 'host',
+                                               'directives', 'text'])):
+    """
+    A single generated Nagios object.
+
+    type is the Nagios object type, name the puppet resource title (or
+    the generated name), host the host_name the object belongs to or
+    None, directives the (name, value) pairs of the object in order and
+    text the rendered object definition.
+    """
+
+
 class NagiosType(object):
     directives = None
+    directive_format = "  %-30s %s\n"
+    # Whether objects of this type can have a host_name and so be
+    # written into the host files.
+    host_objects = True
+    # Whether objects of this type refer to hosts or services, and so
+    # must be reused along with the host files.
+    host_references = True
+    # The share of the time budget this type gets, relative to the
+    # other types.
+    stage_weight = 1
+    # Directives that identify an object or change how it inherits,
+    # these are never moved into a generated template.
+    untemplated = set(['name', 'use', 'register', 'host_name',
+                       'hostgroup_name', 'service_description', 'alias',
+                       'address', 'display_name', 'members'])
 
     def __init__(self, db, output_dir,
                  nodefacts=None,
                  query=None,
                  environment=None,
-                 nagios_hosts={}):
+                 nagios_hosts={},
+                 template_min_uses=None,
+                 servicegroups=None):
         self.db = db
         self.output_dir = output_dir
         self.environment = environment
         self.nodefacts = nodefacts
         self.query = query
         self.nagios_hosts = nagios_hosts
+        self.template_min_uses = template_min_uses
+        self.templates = {}
+        # The auto servicegroup names, when their membership is written on
+        # the services rather than the servicegroups.
+        self.servicegroups = servicegroups
 
     def query_string(self, nagios_type=None):
         if not nagios_type:
@@ -136,11 +271,16 @@ class NagiosType(object):
     def file_name(self):
         return "{0}/auto_{1}.cfg".format(self.output_dir, self.nagios_type)
 
-    def generate_name(self, resource, stream):
-        stream.write("  %-30s %s\n" % (self.nagios_type + '_name',
-                                       resource.name))
+    def file_patterns(self):
+        """Return patterns matching the names of the files generated."""
+        return ["auto_{0}.cfg".format(self.nagios_type)]
+
+    def name_directives(self, resource):
+        return [(self.nagios_type + '_name', resource.name)]
 
-    def generate_parameters(self, resource, stream):
+    def resource_directives(self, resource):
+        """Return the (name, value) directives to write for a resource."""
+        directives = []
         for param_name, param_value in resource.parameters.items():
 
             if not param_value:
@@ -155,29 +295,118 @@ class NagiosType(object):
             if isinstance(param_value, list):
                 param_value = ",".join(param_value)
 
-            stream.write("  %-30s %s\n" % (param_name, param_value))
+            directives.append((param_name, param_value))
+        return directives
+
+    def parameter_directives(self, resource):
+        directives = self.resource_directives(resource)
+
+        # Replace the directives shared with a generated template by
+        # using it.  The generated template comes first so it takes
+        # precedence over any templates the resource already used, just
+        # like the directives it replaces did.
+        if resource.name in self.templates:
+            template_name, factored = self.templates[resource.name]
+            use = [template_name] + [v for n, v in directives if n == 'use']
+            directives = [(n, v) for n, v in directives
+                          if n != 'use' and n not in factored]
+            directives.insert(0, ('use', ",".join(use)))
+        return directives
+
+    def render(self, directives, nagios_type=None):
+        lines = ["define %s {\n" % (nagios_type or self.nagios_type)]
+        lines.extend(self.directive_format % d for d in directives)
+        lines.append("}\n")
+        return "".join(lines)
+
+    def make_object(self, name, directives, host=None, nagios_type=None):
+        return NagiosObject(type=nagios_type or self.nagios_type,
+                            name=name,
+                            host=host,
+                            directives=directives,
+                            text=self.render(directives, nagios_type))
+
+    def object_host(self, resource):
+        """Return the host_name a resource belongs to, if any."""
+        if 'host_name' in resource.parameters:
+            return resource.parameters['host_name']
+        return None
+
+    def resource_object(self, resource):
+        return self.make_object(resource.name,
+                                self.name_directives(resource) +
+                                self.parameter_directives(resource),
+                                host=self.object_host(resource))
+
+    def is_template(self, resource):
+        return str(resource.parameters.get('register', '1')) == '0'
+
+    def templatable_directives(self, resource):
+        """Return the directives of a resource that a template may hold."""
+        if self.is_template(resource):
+            return frozenset()
+        name_directive = self.nagios_type + '_name'
+        return frozenset((n, str(v))
+                         for n, v in self.resource_directives(resource)
+                         if n not in self.untemplated
+                         and n != name_directive
+                         and not str(v).startswith('+'))
+
+    def build_templates(self, resources):
+        """
+        Factor out the directives that resources have in common.
 
-    def generate_resource(self, resource, stream):
-        stream.write("define %s {\n" % self.nagios_type)
-        self.generate_name(resource, stream)
-        self.generate_parameters(resource, stream)
-        stream.write("}\n")
+        Directive values used by at least template_min_uses resources are
+        common, and each distinct set of common directives held by at
+        least template_min_uses resources becomes a template.  The
+        resources are recorded in self.templates so parameter_directives
+        will use the template in place of those directives.
 
-    def generate(self):
-        """
-        Generate a nagios configuration for a single type
+        Template names are derived from their directives so they are
+        stable between runs.
 
-        The output of this will be a single file for each type.
-        eg.
-          auto_hosts.cfg
-          auto_checks.cfg
+        :returns: sorted list of (template name, directives)
         """
-
-        stream = open(self.file_name(), 'w')
-        # Query puppetdb only throwing back the resource that match
-        # the Nagios type.
+        self.templates = {}
+        if not self.template_min_uses:
+            return []
+
+        candidates = [(r.name, self.templatable_directives(r))
+                      for r in resources]
+        counts = Counter(d for name, directives in candidates
+                         for d in directives)
+
+        signatures = {}
+        for name, directives in candidates:
+            common = frozenset(d for d in directives
+                               if counts[d] >= self.template_min_uses)
+            # A single directive is no shorter than the use replacing it.
+            if len(common) > 1:
+                signatures[name] = common
+        uses = Counter(signatures.values())
+
+        templates = {}
+        for name, signature in signatures.items():
+            if uses[signature] < self.template_min_uses:
+                continue
+            if signature not in templates:
+                digest = hashlib.sha1(repr(sorted(signature))
+                                      .encode('utf8')).hexdigest()
+                templates[signature] = "auto_%s_%s" % (self.nagios_type,
+                                                       digest[:12])
+            self.templates[name] = (templates[signature],
+                                    set(n for n, v in signature))
+        return sorted((t, sorted(s)) for s, t in templates.items())
+
+    def template_object(self, template):
+        template_name, directives = template
+        return self.make_object(template_name,
+                                [("name", template_name), ("register", 0)] +
+                                directives)
+
+    def unique_resources(self):
+        """Query puppetdb for the resources that match the Nagios type."""
         unique_list = set([])
-
         for r in self.db.resources(query=self.query_string()):
             # Make sure we do not try and make more than one resource
             # for each one.
@@ -185,24 +414,56 @@ class NagiosType(object):
                 LOG.info("duplicate: %s" % r.name)
                 continue
             unique_list.add(r.name)
-            if 'host_name' in r.parameters:
-                hostname = r.parameters.get('host_name')
-                if hostname not in self.nagios_hosts:
-                    LOG.info("Can't find host %s skipping %s, %s" % (
-                        r.parameters['host_name'],
-                        self.nagios_type,
-                        r.name))
-                else:
-                    s = StringIO()
-                    self.generate_resource(r, s)
-                    s.seek(0)
-                    self.nagios_hosts[hostname].append(s.read())
+            yield r
+
+    def iter_objects(self):
+        """
+        Yield a NagiosObject for each resource of this type.
+
+        Objects are rendered as the resources arrive, unless templates
+        are being generated which needs all of the resources first.
+        Objects for hosts that don't exist are skipped.
+        """
+        resources = self.unique_resources()
+        if self.template_min_uses:
+            resources = list(resources)
+            for template in self.build_templates(resources):
+                yield self.template_object(template)
+
+        for r in resources:
+            hostname = self.object_host(r)
+            if hostname is not None and hostname not in self.nagios_hosts:
+                LOG.info("Can't find host %s skipping %s, %s" % (
+                    hostname,
+                    self.nagios_type,
+                    r.name))
                 continue
-            self.generate_resource(r, stream)
+            yield self.resource_object(r)
+
+    def generate(self):
+        """
+        Generate a nagios configuration for a single type
+
+        The output of this will be a single file for each type.
+        eg.
+          auto_hosts.cfg
+          auto_checks.cfg
+
+        Objects belonging to a host are kept in nagios_hosts to be
+        written with the host.
+        """
+        with open(self.file_name(), 'w') as stream:
+            for obj in self.iter_objects():
+                if obj.host is not None:
+                    self.nagios_hosts[obj.host].append(obj.text)
+                else:
+                    stream.write(obj.text)
 
 
 class NagiosHost(NagiosType):
     nagios_type = 'host'
+    # Every type that refers to hosts is reused when the hosts are stale.
+    stage_weight = 5
     directives = set(['host_name', 'alias', 'display_name', 'address',
                       'parents', 'hostgroups', 'check_command',
                       'initial_state', 'max_check_attempts',
@@ -223,54 +484,65 @@ class NagiosHost(NagiosType):
                       'vrml_image', 'statusmap_image', '2d_coords',
                       '3d_coords', 'use'])
 
-    def generate_name(self, resource, stream):
-        if resource.name in self.nodefacts or 'use' in resource.parameters:
-            stream.write("  %-30s %s\n" % ("host_name", resource.name))
+    def name_directives(self, resource):
+        if self.is_host(resource):
+            return [("host_name", resource.name)]
         else:
-            stream.write("  %-30s %s\n" % ("name", resource.name))
+            return [("name", resource.name)]
 
     def is_host(self, resource):
         if resource.name in self.nodefacts or 'use' in resource.parameters:
             return True
         return False
 
-    def generate(self):
-        unique_list = set([])
+    def file_patterns(self):
+        return ["auto_host.cfg", "host_*.cfg"]
 
-        stream = open(self.file_name(), 'w')
-        # Query puppetdb only throwing back the resource that match
-        # the Nagios type.
-        for r in self.db.resources(query=self.query_string()):
-            # Make sure we do not try and make more than one resource
-            # for each one.
-            if r.name in unique_list:
-                LOG.info("duplicate: %s" % r.name)
-                continue
-            unique_list.add(r.name)
+    def object_host(self, resource):
+        if self.is_host(resource):
+            return resource.name
+        return None
 
-            if self.is_host(r):
+    def generate(self):
+        with open(self.file_name(), 'w') as stream:
+            for obj in self.iter_objects():
+                if obj.host is None:
+                    stream.write(obj.text)
+                    continue
                 tmp_file = ("{0}/host_{1}.cfg"
-                            .format(self.output_dir, r.name))
-                f = open(tmp_file, 'w')
-                self.generate_resource(r, f)
-
-                for resource in sorted(self.nagios_hosts[r.name]):
-                    f.write(resource)
-                f.close()
-                continue
-            else:
-                self.generate_resource(r, stream)
+                            .format(self.output_dir, obj.host))
+                with open(tmp_file, 'w') as f:
+                    f.write(obj.text)
+                    for resource in sorted(self.nagios_hosts[obj.host]):
+                        f.write(resource)
 
 
 class NagiosServiceGroup(NagiosType):
     nagios_type = 'servicegroup'
+    host_objects = False
     directives = set(['servicegroup_name', 'alias', 'members',
                       'servicegroup_members', 'notes', 'notes_url',
                       'action_url'])
 
 
 class NagiosAutoServiceGroup(NagiosType):
-    def generate(self):
+    nagios_type = 'servicegroup'
+    directive_format = " %s %s\n"
+    host_objects = False
+
+    def file_patterns(self):
+        return ["auto_servicegroup_*.cfg"]
+
+    def iter_objects(self):
+        if self.servicegroups is not None:
+            # NagiosService has added the members to the services.
+            for servicegroup_name in sorted(self.servicegroups):
+                yield self.make_object(servicegroup_name,
+                                       [("servicegroup_name",
+                                         servicegroup_name),
+                                        ("alias", servicegroup_name)])
+            return
+
         # Query puppetdb only throwing back the resource that match
         # the Nagios type.
         unique_list = set([])
@@ -298,20 +570,21 @@ class NagiosAutoServiceGroup(NagiosType):
                     .append(host_name)
 
         for servicegroup_name, host_list in servicegroups.items():
-            tmp_file = ("{0}/auto_servicegroup_{1}.cfg"
-                        .format(self.output_dir, servicegroup_name))
-
             members = []
             for host in host_list:
                 members.append("%s,%s" % (host, servicegroup_name))
 
-            f = open(tmp_file, 'w')
-            f.write("define servicegroup {\n")
-            f.write(" servicegroup_name %s\n" % servicegroup_name)
-            f.write(" alias %s\n" % servicegroup_name)
-            f.write(" members %s\n" % ",".join(members))
-            f.write("}\n")
-            f.close()
+            yield self.make_object(servicegroup_name,
+                                   [("servicegroup_name", servicegroup_name),
+                                    ("alias", servicegroup_name),
+                                    ("members", ",".join(members))])
+
+    def generate(self):
+        for obj in self.iter_objects():
+            tmp_file = ("{0}/auto_servicegroup_{1}.cfg"
+                        .format(self.output_dir, obj.name))
+            with open(tmp_file, 'w') as f:
+                f.write(obj.text)
 
 
 class NagiosService(NagiosType):
@@ -337,13 +610,45 @@ class NagiosService(NagiosType):
                       'notes_url', 'action_url', 'icon_image',
                       'icon_image_alt', 'use'])
 
-    def generate_name(self, resource, stream):
+    def name_directives(self, resource):
         if 'host_name' not in resource.parameters:
-            stream.write("  %-30s %s\n" % ("name", resource.name))
+            return [("name", resource.name)]
+        return []
+
+    def auto_servicegroup(self, resource):
+        if self.servicegroups is None \
+           or 'host_name' not in resource.parameters:
+            return None
+        return resource.parameters.get('service_description')
+
+    def resource_directives(self, resource):
+        directives = super(NagiosService, self).resource_directives(resource)
+        servicegroup_name = self.auto_servicegroup(resource)
+        if not servicegroup_name:
+            return directives
+
+        # Make the service a member of its auto servicegroup, adding to
+        # the servicegroups from any template it uses rather than
+        # replacing them.
+        for i, (param_name, param_value) in enumerate(directives):
+            if param_name == 'servicegroups':
+                param_value = "%s,%s" % (param_value, servicegroup_name)
+                directives[i] = (param_name, param_value)
+                break
+        else:
+            directives.append(('servicegroups', '+' + servicegroup_name))
+        return directives
+
+    def resource_object(self, resource):
+        servicegroup_name = self.auto_servicegroup(resource)
+        if servicegroup_name:
+            self.servicegroups.add(servicegroup_name)
+        return super(NagiosService, self).resource_object(resource)
 
 
 class NagiosHostGroup(NagiosType):
     nagios_type = 'hostgroup'
+    host_objects = False
     directives = set(['hostgroup_name', 'alias', 'members',
                       'hostgroup_members', 'notes',
                       'notes_url', 'action_url'])
@@ -375,15 +680,21 @@ class NagiosServiceExtInfo(NagiosType):
 
 class NagiosTimePeriod(NagiosType):
     nagios_type = 'timeperiod'
+    host_objects = False
+    host_references = False
 
 
 class NagiosCommand(NagiosType):
     nagios_type = 'command'
+    host_objects = False
+    host_references = False
     directives = set(['command_name', 'command_line'])
 
 
 class NagiosContact(NagiosType):
     nagios_type = 'contact'
+    host_objects = False
+    host_references = False
     directives = set(['contact_name', 'alias', 'contactgroups',
                       'host_notifications_enabled',
                       'service_notifications_enabled',
@@ -401,88 +712,376 @@ class NagiosContact(NagiosType):
 
 class NagiosContactGroup(NagiosType):
     nagios_type = 'contactgroup'
+    host_objects = False
+    host_references = False
     directives = set(['contactgroup_name', 'alias', 'members',
                       'contactgroup_members'])
 
 
+def template_facts(template):
+    """Return the names of the facts used by a format string template."""
+    names = set()
+    for _, field_name, _, _ in string.Formatter().parse(template):
+        if field_name is not None:
+            names.add(re.match(r'[^.\[]*', field_name).group(0))
+    return names
+
+
+def fact_key(value):
+    """Return a fact value in a form that can be used as a dict key."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class HostGroupTemplate(object):
+    """The compiled name and alias templates of a hostgroup_ section."""
+
+    def __init__(self, section, traits):
+        traits = dict(traits)
+        self.section = section
+        self.fact_template = traits.pop('fact_template', None)
+        self.name = section.split('_', 1)[1]
+        self.alias = traits.pop('name', self.name)
+        # The remaining options are resources the hosts must have.
+        self.traits = traits
+        self.facts = sorted(template_facts(self.name) |
+                            template_facts(self.alias))
+
+    def render(self, values):
+        facts = dict(zip(self.facts, values))
+        return self.name.format(**facts), self.alias.format(**facts)
+
+
 class CustomNagiosHostGroup(NagiosType):
-    def __init__(self, db, output_dir, name,
+    """
+    Hostgroups built from the facts of the hosts, as described by the
+    hostgroup_ sections of the configuration.
+
+    The templates of every section are compiled once to find the facts
+    they use.  The sections that use the same facts and traits share a
+    single index of their hosts by the values of those facts, built with
+    one pass over the hosts, so each template is only formatted once for
+    each distinct set of values.  Nodes missing facts are reported and
+    recorded in self.missing rather than failing.
+    """
+    nagios_type = 'hostgroup'
+    directive_format = " %s %s\n"
+    host_objects = False
+
+    def __init__(self, db, output_dir, hostgroups,
                  nodefacts=None,
                  nodes=None,
                  query=None,
                  environment=None,
                  nagios_hosts={}):
-        self.nagios_type = name
-        self.nodes = nodes
         super(CustomNagiosHostGroup, self).__init__(db=db,
                                                     output_dir=output_dir,
                                                     nodefacts=nodefacts,
                                                     query=query,
-                                                    environment=environment)
+                                                    environment=environment,
+                                                    nagios_hosts=nagios_hosts)
+        self.nodes = nodes
+        self.hostgroups = [HostGroupTemplate(section, traits)
+                           for section, traits in hostgroups.items()]
+        self.missing = {}
 
-    def generate(self, hostgroup_name, traits):
-        traits = dict(traits)
-        fact_template = traits.pop('fact_template')
-        hostgroup_name = hostgroup_name.split('_', 1)[1]
-        hostgroup_alias = traits.pop('name')
+    def file_patterns(self):
+        return ["auto_hostgroup_*.cfg"]
+
+    def trait_members(self, template, resource_nodes):
+        """
+        Return the names of the nodes with all of the template's trait
+        resources, or None when every node is a member.
+
+        resource_nodes caches the nodes with each resource, so each
+        resource is only queried once for all of the templates.
+        """
+        if not template.traits:
+            return None
+        members = set(node.name for node in self.nodes)
+        for type_, title in template.traits.items():
+            if (type_, title) not in resource_nodes:
+                resource_nodes[(type_, title)] = set(
+                    r.node for r in self.db.resources(type_, title))
+            members &= resource_nodes[(type_, title)]
+        # Without any hosts with the resources every host is a member.
+        return members or None
+
+    def index_hosts(self, template, hosts, resource_nodes):
+        """
+        Index the hosts that are members of a template by the values of
+        the facts it uses.
 
-        # Gather hosts base on some resource traits.
-        members = []
+        :returns: ({fact keys: (fact values, [host names])},
+                   [names of the hosts missing the facts])
+        """
+        members = self.trait_members(template, resource_nodes)
+        index = {}
+        missing = []
+        for name in hosts:
+            if members is not None and name not in members:
+                continue
+            facts = self.nodefacts[name]
+            try:
+                values = tuple(facts[f] for f in template.facts)
+            except KeyError:
+                missing.append(name)
+                continue
+            key = tuple(fact_key(v) for v in values)
+            if key not in index:
+                index[key] = (values, [])
+            index[key][1].append(name)
+        return index, missing
+
+    def iter_objects(self):
+        host_names = []
         for node in self.nodes:
-            for type_, title in traits.items():
-                if not len(list(node.resources(type_, title))) > 0:
-                    break
-            else:
-                members.append(node)
-
-        hostgroup = defaultdict(list)
-        for node in members or self.nodes:
             if node.name not in self.nagios_hosts:
                 LOG.info("Skipping host with no nagios_host resource %s" %
                          node.name)
                 continue
-            facts = self.nodefacts[node.name]
-            try:
-                fact_name = hostgroup_name.format(**facts)
-                fact_alias = hostgroup_alias.format(**facts)
-            except KeyError:
-                LOG.error("Can't find facts for hostgroup %s" % fact_template)
-                raise
-            hostgroup[(fact_name, fact_alias)].append(node)
+            host_names.append(node.name)
+
+        resource_nodes = {}
+        indexes = {}
+        self.missing = {}
+        for template in self.hostgroups:
+            key = (tuple(template.facts),
+                   frozenset(template.traits.items()))
+            if key not in indexes:
+                indexes[key] = self.index_hosts(template, host_names,
+                                                resource_nodes)
+            template_groups, missing = indexes[key]
+            self.missing[template.section] = list(missing)
+            hostgroups = {}
+            for values, hosts in template_groups.values():
+                try:
+                    hostgroup = template.render(values)
+                except (LookupError, AttributeError):
+                    self.missing[template.section].extend(hosts)
+                    continue
+                hostgroups.setdefault(hostgroup, []).extend(hosts)
+
+            if self.missing[template.section]:
+                LOG.warning("Can't find facts %s for hostgroup %s on: %s" % (
+                    ", ".join(template.facts), template.section,
+                    ", ".join(self.missing[template.section])))
+
+            for (name, alias), hosts in hostgroups.items():
+                yield self.make_object(name,
+                                       [("hostgroup_name", name),
+                                        ("alias", alias),
+                                        ("members", ",".join(hosts))])
+
+    def generate(self):
+        for obj in self.iter_objects():
+            tmp_file = "{0}/auto_hostgroup_{1}.cfg".format(self.output_dir,
+                                                           obj.name)
+            with open(tmp_file, 'w') as f:
+                f.write(obj.text)
+
+
+class CachedNode(object):
+    """A puppetdb node with its facts already fetched."""
+
+    def __init__(self, node, facts):
+        self.node = node
+        self.cached_facts = facts
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+    def facts(self):
+        return iter(self.cached_facts)
+
+
+class CachedPuppetDB(object):
+    """
+    Share puppetdb fetches between several NagiosConfigs.
+
+    Resources are fetched once for each type, and the nodes and all of
+    their facts once in total, limited only by the query and environment
+    common to every NagiosConfig.  The equality queries that NagiosConfig
+    and NagiosType build are then answered from memory, any other query
+    is passed through to puppetdb.
+    """
+    resource_fields = {'certname': 'node',
+                       'title': 'name',
+                       'type': 'type_',
+                       'tag': 'tags',
+                       'exported': 'exported',
+                       'file': 'sourcefile',
+                       'line': 'sourceline',
+                       'environment': 'environment'}
+    node_fields = {'certname': 'name',
+                   'catalog_environment': 'catalog_environment',
+                   'facts_environment': 'facts_environment',
+                   'report_environment': 'report_environment'}
+
+    def __init__(self, db, query=None, environment=None):
+        self.db = db
+        self.query = list(query or [])
+        self.environment = environment
+        self.clear()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    @property
+    def timeout(self):
+        return self.db.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.db.timeout = timeout
+
+    def clear(self):
+        """Forget everything fetched so it is fetched again when needed."""
+        self.cached_resources = {}
+        self.cached_nodes = None
 
-        # if there are no hosts in the group then exit
-        if not hostgroup.items():
+    def refresh_nodes(self, names):
+        """
+        Fetch again only the resources, nodes and facts of the named nodes.
+
+        Anything else already fetched is kept, nodes that are no longer
+        active are dropped.
+        """
+        names = set(names)
+        for type_, resources in self.cached_resources.items():
+            fetched = []
+            for batch in batches(sorted(names)):
+                query_parts = [["=", n, v] for n, v in self.query]
+                query_parts.append(["=", "type", type_])
+                query_parts.append(["or"] + [["=", "certname", n]
+                                             for n in batch])
+                fetched.extend(self.db.resources(
+                    query=json.dumps(["and"] + query_parts)))
+            resources[:] = [r for r in resources
+                            if r.node not in names] + fetched
+
+        if self.cached_nodes is None:
             return
+        facts = defaultdict(list)
+        nodes = []
+        for batch in batches(sorted(names)):
+            certnames = ["or"] + [["=", "certname", n] for n in batch]
+            node_query = ["and", certnames]
+            fact_query = ["and", certnames]
+            if self.environment:
+                node_query += [["=", "catalog_environment", self.environment],
+                               ["=", "facts_environment", self.environment]]
+                fact_query.append(["=", "environment", self.environment])
+            for f in self.db.facts(query=json.dumps(fact_query)):
+                facts[f.node].append(f)
+            nodes.extend(self.db.nodes(query=json.dumps(node_query)))
+        self.cached_nodes = ([n for n in self.cached_nodes
+                              if n.name not in names] +
+                             [CachedNode(n, facts[n.name]) for n in nodes])
+
+    def parse_query(self, query, fields):
+        """
+        Split an "and" of equality queries into (field, value) pairs.
 
-        for hostgroup_name, hosts in hostgroup.items():
-            tmp_file = "{0}/auto_hostgroup_{1}.cfg".format(self.output_dir,
-                                                           hostgroup_name[0])
-            f = open(tmp_file, 'w')
-            f.write("define hostgroup {\n")
-            f.write(" hostgroup_name %s\n" % hostgroup_name[0])
-            f.write(" alias %s\n" % hostgroup_name[1])
-            f.write(" members %s\n" % ",".join([h.name for h in hosts]))
-            f.write("}\n")
+        None is returned for any query that can't be answered from memory.
+        """
+        if not query:
+            return []
+        query = json.loads(query)
+        clauses = query[1:] if query[0] == 'and' else [query]
+        parsed = []
+        for clause in clauses:
+            if len(clause) != 3 or clause[0] != '=' \
+               or clause[1] not in fields:
+                return None
+            parsed.append((clause[1], clause[2]))
+        return parsed
+
+    def matches(self, obj, clauses, fields):
+        # Like puppetdb, only tags are compared case-insensitively.
+        for name, value in clauses:
+            attr = getattr(obj, fields[name])
+            if name == 'tag':
+                if value.lower() not in [t.lower() for t in attr]:
+                    return False
+            elif attr != value:
+                return False
+        return True
+
+    def resources(self, type_=None, title=None, query=None, **kwargs):
+        clauses = self.parse_query(query, self.resource_fields)
+        types = [v for n, v in (clauses or []) if n == 'type']
+        if type_ or title or kwargs or len(types) != 1:
+            return self.db.resources(type_, title, query=query, **kwargs)
+
+        if types[0] not in self.cached_resources:
+            query_parts = [["=", n, v] for n, v in self.query]
+            query_parts.append(["=", "type", types[0]])
+            self.cached_resources[types[0]] = list(self.db.resources(
+                query=json.dumps(["and"] + query_parts)))
+        return [r for r in self.cached_resources[types[0]]
+                if self.matches(r, clauses, self.resource_fields)]
+
+    def nodes(self, query=None, **kwargs):
+        clauses = self.parse_query(query, self.node_fields)
+        if kwargs or clauses is None:
+            return self.db.nodes(query=query, **kwargs)
+
+        if self.cached_nodes is None:
+            node_query = fact_query = None
+            if self.environment:
+                node_query = json.dumps(
+                    ["and",
+                     ["=", "catalog_environment", self.environment],
+                     ["=", "facts_environment", self.environment]])
+                fact_query = json.dumps(
+                    ["=", "environment", self.environment])
+            facts = defaultdict(list)
+            for f in self.db.facts(query=fact_query):
+                facts[f.node].append(f)
+            self.cached_nodes = [CachedNode(n, facts[n.name])
+                                 for n in self.db.nodes(query=node_query)]
+        return [n for n in self.cached_nodes
+                if self.matches(n, clauses, self.node_fields)]
 
 
 class NagiosConfig:
-    def __init__(self, hostname, port, api_version, output_dir,
+    # Puppetdb stores commands asynchronously, so a change can show up
+    # with a timestamp older than the newest one already seen.
+    change_lag = timedelta(minutes=5)
+
+    def __init__(self, hostname, port, api_version, output_dir=None,
                  nodefacts=None, query=None, environment=None,
-                 ssl_verify=None, ssl_key=None, ssl_cert=None, timeout=None):
-        self.db = connect(host=hostname,
-                          port=port,
-                          ssl_verify=ssl_verify,
-                          ssl_key=ssl_key,
-                          ssl_cert=ssl_cert,
-                          timeout=timeout)
+                 ssl_verify=None, ssl_key=None, ssl_cert=None, timeout=None,
+                 template_min_uses=None, db=None,
+                 auto_servicegroups='members', track_changes=False):
+        self.db = db or connect(host=hostname,
+                                port=port,
+                                ssl_verify=ssl_verify,
+                                ssl_key=ssl_key,
+                                ssl_cert=ssl_cert,
+                                timeout=timeout)
         self.db.resources = self.db.resources
         self.output_dir = output_dir
         self.environment = environment
+        self.last_changed = None
+        self.node_changes = {}
+        self.node_contents = {}
+        self.stale = []
+        self.stale_host_objects = False
         if not nodefacts:
+            if track_changes:
+                # Before the nodes, so anything changed in between is seen
+                # as a change by changed_nodes.
+                self.node_contents = self.get_node_contents()
             self.nodefacts = self.get_nodefacts()
         else:
             self.nodefacts = nodefacts
         self.query = query or {}
+        self.template_min_uses = template_min_uses
+        self.auto_servicegroups = auto_servicegroups
+        self.servicegroups = set()
         self.nagios_hosts = defaultdict(list,
                                         [(h, [])
                                          for h in self.get_nagios_hosts()])
@@ -506,6 +1105,97 @@ class NagiosConfig:
         query.update(kwargs)
         return self.query_string(**query)
 
+    def changed_query_string(self, since):
+        query_parts = ['["=", "node_state", "any"]']
+        if since:
+            changed = ['[">", "%s", "%s"]' % (name, since.isoformat())
+                       for name in ['catalog_timestamp', 'facts_timestamp',
+                                    'deactivated', 'expired']]
+            query_parts.append('["or", %s]' % ", ".join(changed))
+        if self.environment:
+            query_parts.append('["=", "catalog_environment", "%s"]' %
+                               self.environment)
+        return '["and", %s]' % ", ".join(query_parts)
+
+    def node_changed(self, node):
+        """Return the last time a node's catalog, facts or state changed."""
+        return max([t for t in [node.catalog_timestamp,
+                                node.facts_timestamp,
+                                node.deactivated,
+                                node.expired] if t] or [None])
+
+    def update_last_changed(self, nodes):
+        for node in nodes:
+            changed = self.node_changed(node)
+            self.node_changes[node.name] = changed
+            if changed and (not self.last_changed
+                            or changed > self.last_changed):
+                self.last_changed = changed
+
+    def get_node_contents(self, nodes=None):
+        """
+        Return what the catalog, facts and state of each node currently are.
+
+        The catalogs and factsets are identified by their hash, which
+        unlike their timestamps only changes when their content does.
+        Without nodes, every active node in the environment is returned.
+        """
+        if nodes is None:
+            states = defaultdict(lambda: (None, None))
+            filters = ['']
+            if self.environment:
+                filters = ['environment = %s' % json.dumps(self.environment)]
+        else:
+            states = dict((n.name, (n.deactivated, n.expired))
+                          for n in nodes)
+            filters = ['certname in [%s]' % ", ".join(json.dumps(n)
+                                                      for n in batch)
+                       for batch in batches(sorted(states))]
+
+        hashes = defaultdict(lambda: [None, None])
+        for i, endpoint in enumerate(['catalogs', 'factsets']):
+            for query_filter in filters:
+                for item in self.db.pql('%s[certname, hash] { %s }' %
+                                        (endpoint, query_filter)):
+                    hashes[item['certname']][i] = item['hash']
+        return dict((name, tuple(hashes[name]) + states[name])
+                    for name in (hashes if nodes is None else states))
+
+    def changed_nodes(self):
+        """
+        Get the nodes that changed in puppetdb since they were last seen.
+
+        Only nodes with a newer catalog or facts, or that were deactivated
+        or expired, are considered so this is cheap to poll.  The query
+        overlaps the previous one by change_lag to catch changes stored
+        late, nodes already seen with the same timestamp are skipped.
+        Of those, only the nodes whose catalog, facts or state differ
+        from what was last seen are returned, most agent runs change
+        nothing.
+        """
+        since = self.last_changed
+        if since:
+            since -= self.change_lag
+        nodes = [n for n in self.db.nodes(
+                     query=self.changed_query_string(since))
+                 if n.name not in self.node_changes
+                 or self.node_changes[n.name] != self.node_changed(n)]
+        self.update_last_changed(nodes)
+        if not nodes:
+            return []
+        contents = self.get_node_contents(nodes)
+        nodes = [n for n in nodes
+                 if self.node_contents.get(n.name) != contents[n.name]]
+        self.node_contents.update(contents)
+        return nodes
+
+    def refresh(self):
+        """Get the nodes, facts and Nagios hosts from puppetdb again."""
+        self.nodefacts = self.get_nodefacts()
+        self.nagios_hosts = defaultdict(list,
+                                        [(h, [])
+                                         for h in self.get_nagios_hosts()])
+
     def get_nodefacts(self):
         """
         Get all the nodes & facts from puppetdb.
@@ -526,6 +1216,7 @@ class NagiosConfig:
             nodefacts[node.name] = {}
             for f in node.facts():
                 nodefacts[node.name][f.name] = f.value
+        self.update_last_changed(self.nodes)
         return nodefacts
 
     def get_nagios_hosts(self):
@@ -537,38 +1228,195 @@ class NagiosConfig:
             [h.name for h in self.db.resources(
                 query=self.resource_query_string(type='Nagios_host'))])
 
-    def generate_all(self, excluded_classes=[]):
-        for cls in NagiosType.__subclasses__():
-            if cls.__name__.startswith('Custom'):
-                continue
-            if cls.__name__ == 'NagiosHost':
-                continue
-            if cls.__name__ in excluded_classes:
+    def nagios_types(self, excluded_classes=[]):
+        """
+        Return the NagiosTypes to generate.
+
+        NagiosHost is always last, the other types attach their objects
+        to the hosts as they are generated.  NagiosAutoServiceGroup comes
+        after NagiosService, which finds the auto servicegroups when their
+        membership is written on the services.
+        """
+        last = ['NagiosAutoServiceGroup', 'NagiosHost']
+        classes = [cls for cls in NagiosType.__subclasses__()
+                   if not cls.__name__.startswith('Custom')
+                   and cls.__name__ not in last
+                   and cls.__name__ not in excluded_classes]
+        if 'NagiosAutoServiceGroup' not in excluded_classes:
+            classes.append(NagiosAutoServiceGroup)
+        classes.append(NagiosHost)
+
+        servicegroups = None
+        if self.auto_servicegroups == 'services' \
+           and NagiosAutoServiceGroup in classes:
+            servicegroups = self.servicegroups
+        return [cls(db=self.db,
+                    output_dir=self.output_dir,
+                    nodefacts=self.nodefacts,
+                    query=self.query,
+                    environment=self.environment,
+                    nagios_hosts=self.nagios_hosts,
+                    template_min_uses=self.template_min_uses,
+                    servicegroups=servicegroups)
+                for cls in classes]
+
+    def custom_hostgroups(self, hostgroups):
+        return CustomNagiosHostGroup(self.db,
+                                     self.output_dir,
+                                     hostgroups,
+                                     nodefacts=self.nodefacts,
+                                     nodes=self.nodes,
+                                     query=self.query,
+                                     environment=self.environment,
+                                     nagios_hosts=self.nagios_hosts)
+
+    def iter_objects(self, excluded_classes=[], hostgroups={}):
+        """
+        Yield a NagiosObject for every object in the configuration.
+
+        Nothing is written to disk, the objects of each type are rendered
+        as its resources arrive from puppetdb.  Objects that belong to a
+        host have their host set rather than being grouped with it.
+        """
+        self.reset()
+        for inst in self.nagios_types(excluded_classes):
+            for obj in inst.iter_objects():
+                yield obj
+        if hostgroups:
+            for obj in self.custom_hostgroups(hostgroups).iter_objects():
+                yield obj
+
+    def generate_stage(self, name, generate, patterns, deadline=None,
+                       fallback_dir=None):
+        """
+        Run one stage of the generation before the deadline.
+
+        PuppetDB requests are limited to the time left before the
+        deadline.  If the stage fails to get what it needs from PuppetDB,
+        or the deadline has already passed, the stage is recorded as
+        stale and its last good output, the files matching patterns, is
+        reused from fallback_dir.  Without a deadline and fallback_dir
+        any failure is raised.
+        """
+        if deadline is None or fallback_dir is None:
+            generate()
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            timeout = self.db.timeout
+            self.db.timeout = min(timeout or remaining, remaining)
+            try:
+                generate()
+                return
+            except (RequestException, APIError) as e:
+                LOG.warning("%s failed, reusing its last output: %s" %
+                            (name, e))
+            finally:
+                self.db.timeout = timeout
+        else:
+            LOG.warning("%s missed the deadline, reusing its last output" %
+                        name)
+        reuse_config(fallback_dir, self.output_dir, patterns)
+        self.stale.append(name)
+
+    def reset(self):
+        """Forget what was gathered while generating any earlier run."""
+        for services in self.nagios_hosts.values():
+            del services[:]
+        self.servicegroups.clear()
+        self.stale = []
+        self.stale_host_objects = False
+
+    def reuse_stale(self, inst, fallback_dir):
+        """Reuse the last output of a type that refers to stale objects."""
+        name = inst.__class__.__name__
+        LOG.warning("%s has stale objects, reusing its last output" % name)
+        reuse_config(fallback_dir, self.output_dir,
+                     inst.file_patterns())
+        self.stale.append(name)
+
+    def generate_all(self, excluded_classes=[], deadline=None,
+                     fallback_dir=None):
+        """
+        Generate every type into output_dir.
+
+        With a deadline, each type gets its stage_weight share of the time
+        left when it starts.  Once a type with host objects is stale the
+        host files are reused, so every type that refers to hosts or
+        services is reused too, to keep the configuration consistent with
+        them.
+        """
+        self.reset()
+
+        generated = []
+        nagios_types = self.nagios_types(excluded_classes)
+        weights_left = sum(inst.stage_weight for inst in nagios_types)
+        for inst in nagios_types:
+            name = inst.__class__.__name__
+            # Each type gets its share of the time left, so a slow type
+            # can't use up the time of those after it.
+            stage_deadline = share_deadline(deadline, inst.stage_weight,
+                                            weights_left)
+            weights_left -= inst.stage_weight
+            if self.stale_host_objects and inst.host_references:
+                self.reuse_stale(inst, fallback_dir)
                 continue
-            inst = cls(db=self.db,
-                       output_dir=self.output_dir,
-                       nodefacts=self.nodefacts,
-                       query=self.query,
-                       environment=self.environment,
-                       nagios_hosts=self.nagios_hosts)
-            inst.generate()
-
-        hosts = NagiosHost(db=self.db,
-                           output_dir=self.output_dir,
-                           nodefacts=self.nodefacts,
-                           query=self.query,
-                           environment=self.environment,
-                           nagios_hosts=self.nagios_hosts)
-        hosts.generate()
+            self.generate_stage(name, inst.generate, inst.file_patterns(),
+                                deadline=stage_deadline,
+                                fallback_dir=fallback_dir)
+            if name not in self.stale:
+                generated.append(inst)
+            elif inst.host_objects:
+                self.stale_host_objects = True
+
+        if self.stale_host_objects:
+            for inst in generated:
+                if inst.host_references:
+                    self.reuse_stale(inst, fallback_dir)
+
+    def generate_hostgroups(self, hostgroups={}, deadline=None,
+                            fallback_dir=None):
+        if not hostgroups:
+            return
+        inst = self.custom_hostgroups(hostgroups)
+        if self.stale_host_objects:
+            self.reuse_stale(inst, fallback_dir)
+            return
+        self.generate_stage('CustomNagiosHostGroup', inst.generate,
+                            inst.file_patterns(),
+                            deadline=deadline, fallback_dir=fallback_dir)
 
     def verify(self, extra_cfg_dirs=[]):
         LOG.debug("NagiosConfig.verify got extra_cfg_dirs %s" % extra_cfg_dirs)
         return nagios_verify([self.output_dir] + extra_cfg_dirs)
 
 
+class NagiosTarget(object):
+    """A Nagios instance and the puppetdb resources to configure it with."""
+
+    def __init__(self, name, output_dir, nagios_cfg, extra_cfg_dirs=[],
+                 environment=None, query=None, service='nagios4'):
+        self.name = name
+        self.output_dir = output_dir
+        self.nagios_cfg = nagios_cfg
+        self.extra_cfg_dirs = extra_cfg_dirs
+        self.environment = environment
+        self.query = list(query or [])
+        self.service = service
+
+
 def update_nagios(new_config_dir, updated_config, removed_config,
                   backup_dir, output_dir, nagios_cfg,
-                  extra_cfg_dirs=[]):
+                  extra_cfg_dirs=[], precache=False):
+    precache_file = None
+    if precache:
+        precache_file = nagios_precache_file(nagios_cfg)
+        if not precache_file:
+            LOG.warning("Not precaching objects, %s has no "
+                        "precached_object_file" % nagios_cfg)
+    staged_precache_file = precache_file and precache_file + '.new'
+
     # Backup the existing configuration
     shutil.copytree(output_dir, backup_dir)
 
@@ -583,8 +1431,11 @@ def update_nagios(new_config_dir, updated_config, removed_config,
 
     # Verify the config in place.
     try:
-        nagios_verify([output_dir] + extra_cfg_dirs, nagios_cfg)
+        nagios_verify([output_dir] + extra_cfg_dirs, nagios_cfg,
+                      precache_file=staged_precache_file)
     except Exception:
+        if staged_precache_file and path.exists(staged_precache_file):
+            os.remove(staged_precache_file)
         # Remove the new config
         map(lambda d: os.remove(path.join(output_dir, d)),
             os.listdir(output_dir))
@@ -594,6 +1445,10 @@ def update_nagios(new_config_dir, updated_config, removed_config,
                         path.join(output_dir, filename))
         raise
 
+    if staged_precache_file:
+        LOG.info("Installing precached objects: %s" % precache_file)
+        os.rename(staged_precache_file, precache_file)
+
 
 def config_get(config, section, option, default=None):
     try:
@@ -602,6 +1457,13 @@ def config_get(config, section, option, default=None):
         return default
 
 
+def config_getboolean(config, section, option, default=False):
+    try:
+        return config.getboolean(section, option)
+    except Exception:
+        return default
+
+
 def main():
     import argparse
 
@@ -614,8 +1476,9 @@ def main():
     parser = ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument(
-        '--output-dir', action='store', required=True, type=path.abspath,
-        help="The directory to write the Nagios config into.")
+        '--output-dir', action='store', type=path.abspath,
+        help="The directory to write the Nagios config into.  Required "
+        "unless the configuration file has target sections.")
     parser.add_argument(
         '-c', '--config', action='store',
         help="The location of the configuration file..")
@@ -625,6 +1488,18 @@ def main():
     parser.add_argument(
         '--no-restart', action='store_true', default=False,
         help="Restart the Nagios service.")
+    parser.add_argument(
+        '--daemon', action='store_true', default=False,
+        help="Keep running, updating the Nagios configuration whenever "
+        "puppet DB changes.  Requires --update.")
+    parser.add_argument(
+        '--poll-interval', action='store', default=10, type=int,
+        help="How often the daemon checks puppet DB for changes, in "
+        "seconds.")
+    parser.add_argument(
+        '--reload-interval', action='store', default=60, type=int,
+        help="The shortest time between Nagios reloads by the daemon, in "
+        "seconds.")
     parser.add_argument(
         '--host', action='store', default='localhost',
         help="The hostname of the puppet DB server.")
@@ -642,6 +1517,8 @@ def main():
         help="Increase verbosity (specify multiple times for more)")
 
     args = parser.parse_args()
+    if args.daemon and not args.update:
+        parser.error("--daemon requires --update")
 
     log_level = logging.WARNING
     if args.verbose == 1:
@@ -676,12 +1553,18 @@ def main():
     extra_cfg_dirs = [d.strip()
                       for d in get_nagios_cfg('extra_cfg_dirs', '').split(',')
                       if d]
+    precache = config_getboolean(config, 'nagios', 'precache')
 
     get_naginator_cfg = partial(config_get, config, 'naginator')
     excluded_classes = [d.strip()
                         for d in (get_naginator_cfg('excluded_classes', '')
                                   .split(','))
                         if d]
+    template_min_uses = int(get_naginator_cfg('template_min_uses', 0))
+    time_budget = int(get_naginator_cfg('time_budget', 0))
+    auto_servicegroups = get_naginator_cfg('auto_servicegroups', 'members')
+    if auto_servicegroups not in ('members', 'services'):
+        parser.error("auto_servicegroups must be members or services")
 
     hostgroups = {}
     for section in config.sections():
@@ -689,23 +1572,109 @@ def main():
             continue
         hostgroups[section] = config.items(section)
 
+    targets = []
+    for section in config.sections():
+        if not section.startswith('target_'):
+            continue
+        get_target_cfg = partial(config_get, config, section)
+        target_query = [(name[len('query_'):], value)
+                        for name, value in config.items(section)
+                        if name.startswith('query_')]
+        if not get_target_cfg('output_dir'):
+            parser.error("[%s] requires an output_dir" % section)
+        target_dirs = get_target_cfg('extra_cfg_dirs')
+        if target_dirs is not None:
+            target_dirs = [d.strip() for d in target_dirs.split(',') if d]
+        targets.append(NagiosTarget(
+            name=section.split('_', 1)[1],
+            output_dir=path.abspath(get_target_cfg('output_dir')),
+            nagios_cfg=get_target_cfg('nagios_cfg', nagios_cfg),
+            extra_cfg_dirs=(extra_cfg_dirs if target_dirs is None
+                            else target_dirs),
+            environment=get_target_cfg('environment', environment),
+            query=target_query or query,
+            service=get_target_cfg('service', 'nagios4')))
+    if not targets:
+        if not args.output_dir:
+            parser.error("--output-dir is required without target sections")
+        targets.append(NagiosTarget(name='default',
+                                    output_dir=args.output_dir,
+                                    nagios_cfg=nagios_cfg,
+                                    extra_cfg_dirs=extra_cfg_dirs,
+                                    environment=environment,
+                                    query=query))
+
+    # Fetch from puppetdb once for every target, limited only by what
+    # all of the targets ask for.
+    common_query = [q for q in targets[0].query
+                    if all(q in t.query for t in targets)]
+    common_environment = None
+    if len(set(t.environment for t in targets)) == 1:
+        common_environment = targets[0].environment
+
     try:
-        with generate_config(hostname=args.host,
-                             port=args.port,
-                             api_version=args.api_version,
-                             query=query,
-                             environment=environment,
-                             ssl_verify=ssl_verify,
-                             ssl_key=ssl_key,
-                             ssl_cert=ssl_cert,
-                             timeout=timeout,
-                             excluded_classes=excluded_classes,
-                             hostgroups=hostgroups) as nagios_config:
-            if args.update:
-                update_config(nagios_config, args.output_dir,
-                              nagios_cfg, extra_cfg_dirs)
+        db = CachedPuppetDB(connect(host=args.host,
+                                    port=args.port,
+                                    ssl_verify=ssl_verify,
+                                    ssl_key=ssl_key,
+                                    ssl_cert=ssl_cert,
+                                    timeout=timeout),
+                            query=common_query,
+                            environment=common_environment)
+
+        if args.daemon:
+            configs = [(target,
+                        NagiosConfig(hostname=args.host,
+                                     port=args.port,
+                                     api_version=args.api_version,
+                                     output_dir=None,
+                                     query=target.query,
+                                     environment=target.environment,
+                                     template_min_uses=template_min_uses,
+                                     db=db,
+                                     auto_servicegroups=auto_servicegroups,
+                                     track_changes=True))
+                       for target in targets]
+            watch(db, configs,
+                  excluded_classes=excluded_classes,
+                  hostgroups=hostgroups,
+                  precache=precache,
+                  restart=not args.no_restart,
+                  poll_interval=args.poll_interval,
+                  reload_interval=args.reload_interval,
+                  time_budget=time_budget)
+            return
+
+        deadline = None
+        if time_budget:
+            deadline = time.monotonic() + time_budget
+        for i, target in enumerate(targets):
+            LOG.info("Generating Nagios config for %s" % target.name)
+            with generate_config(hostname=args.host,
+                                 port=args.port,
+                                 api_version=args.api_version,
+                                 query=target.query,
+                                 environment=target.environment,
+                                 ssl_verify=ssl_verify,
+                                 ssl_key=ssl_key,
+                                 ssl_cert=ssl_cert,
+                                 timeout=timeout,
+                                 excluded_classes=excluded_classes,
+                                 hostgroups=hostgroups,
+                                 template_min_uses=template_min_uses,
+                                 db=db,
+                                 auto_servicegroups=auto_servicegroups,
+                                 deadline=share_deadline(
+                                     deadline, 1, len(targets) - i),
+                                 fallback_dir=target.output_dir) \
+                    as nagios_config:
+                if args.update:
+                    update_config(nagios_config, target.output_dir,
+                                  target.nagios_cfg, target.extra_cfg_dirs,
+                                  precache=precache)
         if not args.no_restart:
-            nagios_restart()
+            for service in sorted(set(t.service for t in targets)):
+                nagios_restart(service)
     except Exception:
         if args.pdb:
             type, value, tb = sys.exc_info()
@@ -716,16 +1685,30 @@ def main():
 
 
 @contextmanager
-def generate_config(hostname, port, api_version, query, environment,
-                    ssl_verify, ssl_key, ssl_cert, timeout,
-                    excluded_classes=[], hostgroups={}):
+def staging_dir():
     with temporary_dir() as tmp_dir:
         new_config_dir = path.join(tmp_dir, 'new_config')
-
-        # Generate new configuration
         os.mkdir(new_config_dir)
         set_permissions(new_config_dir, stat.S_IRGRP + stat.S_IXGRP)
+        yield new_config_dir
+
 
+@contextmanager
+def generate_config(hostname, port, api_version, query, environment,
+                    ssl_verify, ssl_key, ssl_cert, timeout,
+                    excluded_classes=[], hostgroups={},
+                    template_min_uses=None, db=None,
+                    auto_servicegroups='members', deadline=None,
+                    fallback_dir=None):
+    """
+    Generate the configuration into a temporary directory.
+
+    With a deadline, any type that can't be generated in its share of the
+    time reuses its files from fallback_dir and is listed in the stale
+    attribute of the NagiosConfig, see NagiosConfig.generate_all.
+    """
+    with staging_dir() as new_config_dir:
+        # Generate new configuration
         cfg = NagiosConfig(hostname=hostname,
                            port=port,
                            api_version=api_version,
@@ -735,26 +1718,25 @@ def generate_config(hostname, port, api_version, query, environment,
                            ssl_verify=ssl_verify,
                            ssl_key=ssl_key,
                            ssl_cert=ssl_cert,
-                           timeout=timeout)
-        cfg.generate_all(excluded_classes=excluded_classes)
-
-        for name, cfg in hostgroups.items():
-            group = CustomNagiosHostGroup(cfg.db,
-                                          new_config_dir,
-                                          name,
-                                          nodefacts=cfg.nodefacts,
-                                          nodes=cfg.nodes,
-                                          query=query,
-                                          environment=environment,
-                                          nagios_hosts=cfg.nagios_hosts)
-            group.generate(name, cfg)
+                           timeout=timeout,
+                           template_min_uses=template_min_uses,
+                           db=db,
+                           auto_servicegroups=auto_servicegroups)
+        cfg.generate_all(excluded_classes=excluded_classes,
+                         deadline=deadline, fallback_dir=fallback_dir)
+        cfg.generate_hostgroups(hostgroups,
+                                deadline=deadline, fallback_dir=fallback_dir)
+        if cfg.stale:
+            LOG.warning("Reused the last output of stale types: %s" %
+                        ", ".join(cfg.stale))
         try:
             yield cfg
         finally:
             pass
 
 
-def update_config(config, output_dir, nagios_cfg, extra_cfg_dirs):
+def update_config(config, output_dir, nagios_cfg, extra_cfg_dirs,
+                  precache=False):
     with temporary_dir() as tmp_dir:
         backup_dir = path.join(tmp_dir, 'backup_config')
 
@@ -764,11 +1746,109 @@ def update_config(config, output_dir, nagios_cfg, extra_cfg_dirs):
         # Only remove the auto files, leaving the old hosts.
         removed_config = [f for f in diff.right_only if f.startswith('auto_')]
         if not updated_config:
-            return
+            return False
 
         # Validate new configuration
         config.verify(extra_cfg_dirs=extra_cfg_dirs)
 
         update_nagios(config.output_dir, updated_config, removed_config,
                       backup_dir, output_dir, nagios_cfg=nagios_cfg,
-                      extra_cfg_dirs=extra_cfg_dirs)
+                      extra_cfg_dirs=extra_cfg_dirs, precache=precache)
+        return True
+
+
+def watch(db, configs, excluded_classes=[], hostgroups={}, precache=False,
+          restart=True, poll_interval=10, reload_interval=60,
+          time_budget=None):
+    """
+    Keep the Nagios configuration of each target up to date with puppetdb.
+
+    Puppetdb is polled every poll_interval seconds for nodes that have
+    changed and a target's configuration is only regenerated when some of
+    its nodes have.  Nagios is reloaded at most once every reload_interval
+    seconds, any changes seen in the meantime are deployed together.
+    Only the changed nodes are fetched again from puppetdb before they
+    are deployed.  Each deploy gets time_budget seconds, shared by the
+    targets, see generate_config.
+
+    :param db: the CachedPuppetDB shared by the configs
+    :param configs: list of (NagiosTarget, NagiosConfig)
+    """
+    pending = set(target.name for target, config in configs)
+    # The targets with nodes that changed since they were last deployed,
+    # and the nodes not yet fetched again.
+    changed = set()
+    unfetched = set()
+    last_deploy = None
+    while True:
+        try:
+            for target, config in configs:
+                nodes = config.changed_nodes()
+                if nodes:
+                    LOG.info("Changed nodes for %s: %s" % (
+                        target.name,
+                        ', '.join(sorted(n.name for n in nodes))))
+                    pending.add(target.name)
+                    changed.add(target.name)
+                    unfetched.update(n.name for n in nodes)
+
+            if pending and (last_deploy is None or
+                            time.monotonic() - last_deploy >=
+                            reload_interval):
+                last_deploy = time.monotonic()
+                if unfetched:
+                    db.refresh_nodes(unfetched)
+                    unfetched.clear()
+                deadline = None
+                if time_budget:
+                    deadline = last_deploy + time_budget
+                targets_left = len(pending)
+
+                services = set()
+                for target, config in configs:
+                    if target.name not in pending:
+                        continue
+                    target_deadline = share_deadline(deadline, 1,
+                                                     targets_left)
+                    targets_left -= 1
+                    try:
+                        if target.name in changed:
+                            config.refresh()
+                        with staging_dir() as new_config_dir:
+                            config.output_dir = new_config_dir
+                            config.generate_all(
+                                excluded_classes=excluded_classes,
+                                deadline=target_deadline,
+                                fallback_dir=target.output_dir)
+                            config.generate_hostgroups(
+                                hostgroups,
+                                deadline=target_deadline,
+                                fallback_dir=target.output_dir)
+                            if config.stale:
+                                LOG.warning(
+                                    "Reused the last output of stale "
+                                    "types for %s: %s" % (
+                                        target.name,
+                                        ", ".join(config.stale)))
+                            if update_config(config, target.output_dir,
+                                             target.nagios_cfg,
+                                             target.extra_cfg_dirs,
+                                             precache=precache):
+                                services.add(target.service)
+                    except Exception:
+                        # Retried in the next reload window
+                        LOG.exception("Failed to update the Nagios "
+                                      "configuration for %s" %
+                                      target.name)
+                        continue
+                    changed.discard(target.name)
+                    # Stale types are retried in the next reload window.
+                    if not config.stale:
+                        pending.discard(target.name)
+
+                if restart:
+                    for service in sorted(services):
+                        nagios_reload(service)
+        except Exception:
+            LOG.exception("Failed to update the Nagios configuration")
+        time.sleep(poll_interval)
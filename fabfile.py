@@ -1,47 +1,124 @@
 #!/usr/bin/env python
 """
 Generate the nagios configuration from puppetdb via genreate_poc then
-push the configuration to the nagios server.
+push the configuration to the nagios servers.
 """
+import io
+import os
+import re
+import hashlib
+import tarfile
+import tempfile
+from os import path
 
-from fabric.api import env, local, sudo, task, puts, settings, hide
-from fabric.api import put
-from external_naginator import NagiosConfig
+from fabric.api import run, sudo, task, puts, settings, hide
+from fabric.api import execute, parallel, put
+from external_naginator import NagiosConfig, temporary_dir
 
-env.host_string = 'yournagiossyserver.fqdn'
+NAGIOS_SERVERS = ['yournagiossyserver.fqdn']
 
-TMP_DIR = "/tmp/nagios_tmp"
+NAGIOS_CONF_DIR = "/etc/nagios3/conf.d"
 
+SHA1SUM_LINE = re.compile(r'^([0-9a-f]{40})  (.+)$')
 
-@task
-def deploy(puppetdb_host="puppet", puppetdb_port=8080, puppetdb_apiversion=3):
-    " Generate the nagios configuration and push them into production"
 
-    TMP_FILES = "{0}/auto_*.cfg".format(TMP_DIR)
+def config_digests(config_dir):
+    "Return the sha1 of each file in the generated configuration"
+    digests = {}
+    for filename in os.listdir(config_dir):
+        with open(path.join(config_dir, filename), 'rb') as f:
+            digests[filename] = hashlib.sha1(f.read()).hexdigest()
+    return digests
+
+
+def readable(tarinfo):
+    "Make sure the pushed files are readable by everyone"
+    tarinfo.mode = 0o644
+    return tarinfo
+
+
+def remote_digests():
+    "Return the sha1 of each generated file on the nagios server"
+    with settings(hide('everything'), warn_only=True):
+        output = sudo("cd {0} && find . -maxdepth 1 -type f "
+                      "\\( -name 'auto_*.cfg' -o -name 'host_*.cfg' \\) "
+                      "-printf '%P\\0' | xargs -0 -r sha1sum"
+                      .format(NAGIOS_CONF_DIR))
+    digests = {}
+    for line in output.splitlines():
+        match = SHA1SUM_LINE.match(line.strip())
+        if match:
+            digests[match.group(2)] = match.group(1)
+    return digests
+
 
-    # Delete the auto_ files from the last run
-    local("rm {0}".format(TMP_FILES))
+@parallel
+def push(config_dir, digests):
+    "Push the files that differ to the nagios server and reload it"
+    current = remote_digests()
+    changed = sorted(f for f, digest in digests.items()
+                     if current.get(f) != digest)
+    # Only remove the auto files, leaving the old hosts.
+    removed = sorted(f for f in current
+                     if f not in digests and f.startswith('auto_'))
+    if not changed and not removed:
+        return False
 
-    # Generate the nagios configuration into a temp dir
-    puts("Generating files")
-    with settings(hide('everything')):
-        cfg = NagiosConfig(hostname=puppetdb_host,
-                           port=puppetdb_port,
-                           api_version=puppetdb_apiversion,
-                           output_dir=TMP_DIR)
-        cfg.generate_all()
+    if changed:
+        puts("Pushing {0} changed files".format(len(changed)))
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as archive:
+            with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+                for filename in changed:
+                    tar.add(path.join(config_dir, filename), filename,
+                            filter=readable)
+            archive.flush()
+
+            remote_archive = run("mktemp")
+            put(archive.name, remote_archive)
+        sudo("tar --no-same-owner -xzf {0} -C {1}"
+             .format(remote_archive, NAGIOS_CONF_DIR))
+        run("rm {0}".format(remote_archive))
+
+    if removed:
+        puts("Removing {0} files".format(len(removed)))
+        # Pass the names on stdin, there may be too many for one command.
+        remote_list = run("mktemp")
+        put(io.BytesIO(b"\0".join(f.encode() for f in removed)),
+            remote_list)
+        with settings(hide('everything')):
+            sudo("cd {0} && xargs -0 rm -f -- < {1}"
+                 .format(NAGIOS_CONF_DIR, remote_list))
+        run("rm {0}".format(remote_list))
+
+    sudo("service nagios3 reload")
+    return True
+
+
+@task
+def deploy(puppetdb_host="puppet", puppetdb_port=8080, puppetdb_apiversion=3,
+           servers=None):
+    """
+    Generate the nagios configuration and push the changes into production
 
-    # Clean up the current auto_*.cfg on nagios01
-    with settings(warn_only=True):
-        sudo("rm /etc/nagios3/conf.d/auto_*.cfg")
-        sudo("rm {0}".format(TMP_FILES))
+    Only the files that differ are sent to each nagios server, the servers
+    are updated in parallel and only those that changed are reloaded.
+    servers is a ; separated list, defaulting to NAGIOS_SERVERS.
+    """
+    servers = servers.split(';') if servers else NAGIOS_SERVERS
 
-    # Copy them to the remote nagios server
-    put(TMP_FILES, TMP_DIR)
-    sudo("cp {0} /etc/nagios3/conf.d/".format(TMP_FILES))
+    with temporary_dir() as config_dir:
+        # Generate the nagios configuration into a temp dir
+        puts("Generating files")
+        with settings(hide('everything')):
+            cfg = NagiosConfig(hostname=puppetdb_host,
+                               port=puppetdb_port,
+                               api_version=puppetdb_apiversion,
+                               output_dir=config_dir)
+            cfg.generate_all()
 
-    # Make sure they are readable by everyone
-    sudo("chmod a+r /etc/nagios3/conf.d/auto_*.cfg")
+        results = execute(push, config_dir, config_digests(config_dir),
+                          hosts=servers)
 
-    # Restart nagios on nagios01
-    sudo("sudo service nagios3 reload")
+    for host in sorted(results):
+        puts("{0}: {1}".format(host, "reloaded" if results[host]
+                               else "unchanged"))
@@ -17,7 +17,8 @@ setup(
     keywords="puppetdb nagios",
     url="http://github.com/daniellawrence/external_naginator",
     install_requires=[
-        'pypuppetdb >= 0.0.4'
+        'pypuppetdb >= 0.0.4',
+        'requests',
     ],
     entry_points={
         'console_scripts':
@@ -1,4 +1,76 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from requests.exceptions import RequestException
+
+
+class Resource(object):
+
+    def __init__(self, name, node=None, tags=[], type_='Nagios_host',
+                 **parameters):
+        self.name = name
+        self.node = node
+        self.type_ = type_
+        self.tags = tags
+        self.parameters = parameters
+
+
+def query_certnames(query):
+    """Return the certnames an "or" clause of a query is limited to."""
+    clauses = query[1:] if query and query[0] == 'and' else [query]
+    return [c[2] for clause in clauses if clause and clause[0] == 'or'
+            for c in clause[1:] if c[1] == 'certname']
+
+
+class PuppetDB(object):
+    timeout = None
+
+    def __init__(self, resources, nodes=[], contents={}):
+        self.resources_by_type = resources
+        self.node_list = nodes
+        # The (catalog hash, factset hash) of each node
+        self.contents = contents
+        self.queries = []
+
+    def nodes(self, query=None):
+        self.queries.append(query and json.loads(query))
+        certnames = query_certnames(self.queries[-1])
+        return iter(n for n in self.node_list
+                    if not certnames or n.name in certnames)
+
+    def facts(self, query=None):
+        self.queries.append(query and json.loads(query))
+        return iter([])
+
+    def pql(self, query):
+        self.queries.append(query)
+        endpoint = query.split('[')[0]
+        names = None
+        if 'certname in' in query:
+            names = re.findall(r'"([^"]*)"', query)
+        return iter({'certname': name,
+                     'hash': hashes[endpoint == 'factsets']}
+                    for name, hashes in sorted(self.contents.items())
+                    if names is None or name in names)
+
+    def resources(self, type_=None, title=None, query=None):
+        self.queries.append(json.loads(query))
+        clauses = self.queries[-1]
+        clauses = clauses[1:] if clauses[0] == 'and' else [clauses]
+        [type_] = [c[2] for c in clauses if c[:2] == ['=', 'type']]
+        resources = self.resources_by_type.get(type_, [])
+        if isinstance(resources, Exception):
+            raise resources
+        certnames = query_certnames(self.queries[-1])
+        return iter(r for r in resources
+                    if not certnames or r.node in certnames)
 
 
 class TestGenerate(unittest.TestCase):
@@ -11,5 +83,694 @@ class TestGenerate(unittest.TestCase):
         import external_naginator  # NOQA
 
 
+class TestTemplates(unittest.TestCase):
+
+    def nagios_service(self, template_min_uses):
+        from external_naginator import NagiosService
+        return NagiosService(db=None, output_dir=None,
+                             template_min_uses=template_min_uses)
+
+    def render(self, service, resource):
+        return [[n, str(v)]
+                for n, v in service.parameter_directives(resource)]
+
+    def test_shared_directives(self):
+        service = self.nagios_service(2)
+        resources = [Resource('web%s' % i,
+                              host_name='web%s' % i,
+                              service_description='http',
+                              check_interval=5,
+                              contact_groups=['ops', 'web'],
+                              notes='web%s' % i)
+                     for i in range(3)]
+        templates = service.build_templates(resources)
+
+        self.assertEqual(1, len(templates))
+        name, directives = templates[0]
+        self.assertEqual([('check_interval', '5'),
+                          ('contact_groups', 'ops,web')], directives)
+        self.assertEqual([['use', name],
+                          ['host_name', 'web0'],
+                          ['service_description', 'http'],
+                          ['notes', 'web0']],
+                         self.render(service, resources[0]))
+
+    def test_existing_use_and_register(self):
+        service = self.nagios_service(2)
+        resources = [Resource('db%s' % i,
+                              host_name='db%s' % i,
+                              use='generic-service',
+                              check_interval=5,
+                              notification_period='24x7')
+                     for i in range(2)]
+        resources.append(Resource('generic-service',
+                                  register=0,
+                                  check_interval=5,
+                                  notification_period='24x7'))
+        [(name, directives)] = service.build_templates(resources)
+
+        self.assertEqual(['use', '%s,generic-service' % name],
+                         self.render(service, resources[0])[0])
+        self.assertNotIn('generic-service', service.templates)
+
+    def test_disabled(self):
+        service = self.nagios_service(None)
+        resources = [Resource('web%s' % i, check_interval=5, notes='x')
+                     for i in range(3)]
+        self.assertEqual([], service.build_templates(resources))
+        self.assertEqual([['check_interval', '5'], ['notes', 'x']],
+                         self.render(service, resources[0]))
+
+
+class TestPrecache(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.nagios_cfg = os.path.join(self.config_dir, 'nagios.cfg')
+        # There may be no nagios group to give the files to.
+        patcher = mock.patch('external_naginator.set_permissions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_nagios_cfg(self, *lines):
+        with open(self.nagios_cfg, 'w') as f:
+            f.write("\n".join(lines))
+
+    def test_precache_file(self):
+        from external_naginator import nagios_precache_file
+        self.write_nagios_cfg("cfg_dir=/etc/nagios4/conf.d",
+                              "precached_object_file = objects.precache")
+        self.assertEqual(os.path.join(self.config_dir, 'objects.precache'),
+                         nagios_precache_file(self.nagios_cfg))
+
+        self.write_nagios_cfg("precached_object_file=/var/cache/o.precache")
+        self.assertEqual('/var/cache/o.precache',
+                         nagios_precache_file(self.nagios_cfg))
+
+        self.write_nagios_cfg("cfg_dir=/etc/nagios4/conf.d",
+                              "precached_object_file=")
+        self.assertIsNone(nagios_precache_file(self.nagios_cfg))
+
+    def test_precache_config(self):
+        from external_naginator import nagios_precache_config
+        self.write_nagios_cfg("cfg_dir=conf.d",
+                              "precached_object_file=objects.precache")
+        with nagios_precache_config(self.nagios_cfg,
+                                    '/tmp/o.precache.new') as config_file:
+            self.assertEqual(self.config_dir, os.path.dirname(config_file))
+            with open(config_file) as f:
+                self.assertEqual(["cfg_dir=conf.d",
+                                  "precached_object_file=/tmp/o.precache.new"],
+                                 f.read().splitlines())
+        self.assertFalse(os.path.exists(config_file))
+
+        with nagios_precache_config(self.nagios_cfg, None) as config_file:
+            self.assertEqual(self.nagios_cfg, config_file)
+
+    def update_nagios(self, verify):
+        from external_naginator import update_nagios
+        self.write_nagios_cfg("precached_object_file=objects.precache")
+        new_dir = os.path.join(self.config_dir, 'new')
+        output_dir = os.path.join(self.config_dir, 'conf.d')
+        os.mkdir(new_dir)
+        os.mkdir(output_dir)
+        with open(os.path.join(new_dir, 'auto_command.cfg'), 'w') as f:
+            f.write('new')
+        with mock.patch('external_naginator.nagios_verify',
+                        side_effect=verify) as nagios_verify:
+            update_nagios(new_dir, ['auto_command.cfg'], [],
+                          os.path.join(self.config_dir, 'backup'),
+                          output_dir, self.nagios_cfg, precache=True)
+        return nagios_verify
+
+    def precache(self, config_dirs, config_file, precache_file):
+        with open(precache_file, 'w') as f:
+            f.write('precached')
+
+    def test_update_nagios(self):
+        precache_file = os.path.join(self.config_dir, 'objects.precache')
+        nagios_verify = self.update_nagios(self.precache)
+
+        nagios_verify.assert_called_once_with(
+            [os.path.join(self.config_dir, 'conf.d')], self.nagios_cfg,
+            precache_file=precache_file + '.new')
+        self.assertFalse(os.path.exists(precache_file + '.new'))
+        with open(precache_file) as f:
+            self.assertEqual('precached', f.read())
+
+    def test_update_nagios_fails(self):
+        precache_file = os.path.join(self.config_dir, 'objects.precache')
+
+        def verify(*args, **kwargs):
+            self.precache(*args, **kwargs)
+            raise Exception("Nagios validation failed.")
+
+        self.assertRaises(Exception, self.update_nagios, verify)
+        self.assertFalse(os.path.exists(precache_file + '.new'))
+        self.assertFalse(os.path.exists(precache_file))
+
+
+class TestIterObjects(unittest.TestCase):
+
+    def test_service_objects(self):
+        from external_naginator import NagiosService
+        db = PuppetDB({'Nagios_service': [
+            Resource('http-web1', type_='Nagios_service', host_name='web1',
+                     service_description='http', check_interval=5),
+            Resource('http-gone', type_='Nagios_service', host_name='gone',
+                     service_description='http'),
+            Resource('generic', type_='Nagios_service', register='0'),
+        ]})
+        service = NagiosService(db=db, output_dir=None,
+                                nagios_hosts={'web1': []})
+        objects = list(service.iter_objects())
+
+        self.assertEqual([('http-web1', 'web1'), ('generic', None)],
+                         [(o.name, o.host) for o in objects])
+        self.assertEqual([('host_name', 'web1'),
+                          ('service_description', 'http'),
+                          ('check_interval', 5)], objects[0].directives)
+        self.assertEqual("define service {\n"
+                         "  name                           generic\n"
+                         "  register                       0\n"
+                         "}\n", objects[1].text)
+
+    def test_servicegroups_on_services(self):
+        from external_naginator import NagiosService, NagiosAutoServiceGroup
+        db = PuppetDB({'Nagios_service': [
+            Resource('http-web1', type_='Nagios_service', host_name='web1',
+                     service_description='http', servicegroups=['web']),
+            Resource('ssh-web1', type_='Nagios_service', host_name='web1',
+                     service_description='ssh'),
+        ]})
+        servicegroups = set()
+        kwargs = dict(db=db, output_dir=None, nagios_hosts={'web1': []},
+                      servicegroups=servicegroups)
+        services = list(NagiosService(**kwargs).iter_objects())
+        groups = list(NagiosAutoServiceGroup(**kwargs).iter_objects())
+
+        self.assertEqual([('servicegroups', 'web,http'),
+                          ('servicegroups', '+ssh')],
+                         [d for o in services for d in o.directives
+                          if d[0] == 'servicegroups'])
+        self.assertEqual([[('servicegroup_name', 'http'), ('alias', 'http')],
+                          [('servicegroup_name', 'ssh'), ('alias', 'ssh')]],
+                         [o.directives for o in groups])
+        self.assertEqual(1, len(db.queries))
+
+    def test_servicegroups_on_templated_services(self):
+        from external_naginator import NagiosService
+        db = PuppetDB({'Nagios_service': [
+            Resource('generic', type_='Nagios_service', register='0',
+                     servicegroups=['web']),
+        ] + [
+            Resource('http-web%s' % i, type_='Nagios_service',
+                     host_name='web%s' % i, service_description='http',
+                     use='generic', check_interval=5, notes='x')
+            for i in range(2)
+        ]})
+        service = NagiosService(db=db, output_dir=None,
+                                nagios_hosts={'web0': [], 'web1': []},
+                                template_min_uses=2, servicegroups=set())
+        objects = list(service.iter_objects())
+
+        # The template's servicegroups are added to, not replaced.
+        self.assertEqual(['+http', '+http'],
+                         [v for o in objects for n, v in o.directives
+                          if n == 'servicegroups' and o.host])
+        [template] = [o for o in objects if o.name.startswith('auto_')]
+        self.assertNotIn('servicegroups', dict(template.directives))
+
+
+class TestCachedPuppetDB(unittest.TestCase):
+
+    def test_resources(self):
+        from external_naginator import CachedPuppetDB
+        resources = [Resource('a', node='n1', tags=['prod', 'web']),
+                     Resource('b', node='n2', tags=['prod', 'db'])]
+        db = PuppetDB({'Nagios_host': resources})
+        cached = CachedPuppetDB(db, query=[('tag', 'prod')])
+
+        def query(*clauses):
+            return json.dumps(["and"] + [["=", n, v] for n, v in clauses])
+
+        self.assertEqual(['a'], [r.name for r in cached.resources(
+            query=query(('tag', 'web'), ('type', 'Nagios_host')))])
+        self.assertEqual(['b'], [r.name for r in cached.resources(
+            query=query(('certname', 'n2'), ('type', 'Nagios_host')))])
+        self.assertEqual(['a'], [r.name for r in cached.resources(
+            query=query(('tag', 'WEB'), ('type', 'Nagios_host')))])
+        self.assertEqual([], [r.name for r in cached.resources(
+            query=query(('certname', 'N2'), ('type', 'Nagios_host')))])
+        self.assertEqual(['a', 'b'], [r.name for r in cached.resources(
+            query=json.dumps(["=", "type", "Nagios_host"]))])
+        self.assertEqual([["and", ["=", "tag", "prod"],
+                           ["=", "type", "Nagios_host"]]], db.queries)
+
+        # Anything but equality goes to puppetdb
+        cached.resources(query=json.dumps(
+            ["and", ["~", "tag", "pro"], ["=", "type", "Nagios_host"]]))
+        self.assertEqual(2, len(db.queries))
+
+    def test_refresh_nodes(self):
+        from external_naginator import CachedPuppetDB
+        resources = [Resource('a', node='n1'), Resource('b', node='n2')]
+        db = PuppetDB({'Nagios_host': resources}, [Node('n1'), Node('n2')])
+        cached = CachedPuppetDB(db)
+        query = json.dumps(["=", "type", "Nagios_host"])
+        self.assertEqual(['a', 'b'],
+                         [r.name for r in cached.resources(query=query)])
+        self.assertEqual(['n1', 'n2'], [n.name for n in cached.nodes()])
+
+        resources[0] = Resource('a2', node='n1')
+        db.node_list = [db.node_list[1]]
+        del db.queries[:]
+        cached.refresh_nodes(['n1'])
+
+        self.assertEqual(['b', 'a2'],
+                         [r.name for r in cached.resources(query=query)])
+        self.assertEqual(['n2'], [n.name for n in cached.nodes()])
+        self.assertEqual(
+            [["and", ["=", "type", "Nagios_host"],
+              ["or", ["=", "certname", "n1"]]],
+             ["and", ["or", ["=", "certname", "n1"]]],
+             ["and", ["or", ["=", "certname", "n1"]]]],
+            db.queries)
+
+
+class Node(object):
+
+    def __init__(self, name, catalog_timestamp=None, facts_timestamp=None,
+                 deactivated=None, expired=None):
+        self.name = name
+        self.catalog_timestamp = catalog_timestamp
+        self.facts_timestamp = facts_timestamp
+        self.deactivated = deactivated
+        self.expired = expired
+
+    def facts(self):
+        return iter([])
+
+
+class TestChangedNodes(unittest.TestCase):
+
+    def test_changed_nodes(self):
+        from external_naginator import NagiosConfig
+        t0 = datetime(2020, 1, 1)
+        nodes = [Node('a', facts_timestamp=t0),
+                 Node('b', catalog_timestamp=t0,
+                      expired=t0 + timedelta(minutes=10))]
+        contents = {'a': ('catalog-a', 'facts-a'),
+                    'b': ('catalog-b', 'facts-b')}
+        db = PuppetDB({'Nagios_host': []}, nodes, contents)
+        config = NagiosConfig(None, None, None, db=db, track_changes=True)
+
+        def changed_nodes():
+            names = [n.name for n in config.changed_nodes()]
+            self.last_query = [q for q in db.queries
+                               if isinstance(q, list)][-1]
+            return names
+
+        self.assertEqual(t0 + timedelta(minutes=10),
+                         config.node_changed(nodes[1]))
+        self.assertEqual([], changed_nodes())
+        since = (t0 + timedelta(minutes=5)).isoformat()
+        self.assertEqual(
+            ["and", ["=", "node_state", "any"],
+             ["or"] + [[">", name, since]
+                       for name in ['catalog_timestamp', 'facts_timestamp',
+                                    'deactivated', 'expired']]],
+            self.last_query)
+
+        # A change stored late, older than the newest one already seen
+        nodes.append(Node('c', catalog_timestamp=t0 + timedelta(minutes=8)))
+        contents['c'] = ('catalog-c', 'facts-c')
+        self.assertEqual(['c'], changed_nodes())
+        self.assertEqual([], changed_nodes())
+
+        # Only a change of content or state counts
+        nodes[0].facts_timestamp = t0 + timedelta(minutes=20)
+        self.assertEqual([], changed_nodes())
+        nodes[0].facts_timestamp = t0 + timedelta(minutes=30)
+        contents['a'] = ('catalog-a', 'facts-a2')
+        self.assertEqual(['a'], changed_nodes())
+        nodes[1].deactivated = t0 + timedelta(minutes=40)
+        self.assertEqual(['b'], changed_nodes())
+
+    def test_changed_query_string(self):
+        from external_naginator import NagiosConfig
+        db = PuppetDB({'Nagios_host': []})
+        config = NagiosConfig(None, None, None, nodefacts={'a': {}}, db=db,
+                              environment='production')
+        self.assertEqual(
+            ["and", ["=", "node_state", "any"],
+             ["=", "catalog_environment", "production"]],
+            json.loads(config.changed_query_string(None)))
+
+
+class WatchConfig(object):
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.refreshed = 0
+        self.stale = []
+        self.output_dir = None
+
+    def changed_nodes(self):
+        return self.changes.pop(0) if self.changes else []
+
+    def refresh(self):
+        self.refreshed += 1
+
+    def generate_all(self, **kwargs):
+        pass
+
+    def generate_hostgroups(self, hostgroups, **kwargs):
+        pass
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_watch(self):
+        import external_naginator
+        from external_naginator import NagiosTarget, watch
+        now = [0]
+        deployed = []
+        reloaded = []
+        refreshed = []
+
+        def sleep(seconds):
+            now[0] += seconds
+            if now[0] >= 80:
+                raise StopIteration()
+
+        def update_config(config, output_dir, *args, **kwargs):
+            deployed.append((now[0], output_dir))
+            # The first deploy of b fails
+            if deployed == [(0, 'a'), (0, 'b')]:
+                raise Exception("Nagios validation failed.")
+            return True
+
+        db = mock.Mock()
+        db.refresh_nodes.side_effect = \
+            lambda names: refreshed.append((now[0], sorted(names)))
+        configs = [
+            (NagiosTarget('a', 'a', None, [], None, {}, 'nagios4'),
+             WatchConfig([[Node('n0')], [], [Node('n1')], [Node('n2')]])),
+            (NagiosTarget('b', 'b', None, [], None, {}, 'nagios-b'),
+             WatchConfig([])),
+        ]
+        with mock.patch('time.monotonic', lambda: now[0]), \
+                mock.patch('time.sleep', sleep), \
+                mock.patch.object(external_naginator, 'update_config',
+                                  update_config), \
+                mock.patch.object(external_naginator, 'nagios_reload',
+                                  lambda s: reloaded.append((now[0], s))), \
+                mock.patch.object(external_naginator, 'set_permissions'), \
+                self.assertLogs('external_naginator', 'ERROR'):
+            self.assertRaises(StopIteration, watch, db, configs,
+                              poll_interval=10, reload_interval=60)
+
+        # Changes are deployed together once the reload interval passes,
+        # a failed target is retried then.
+        self.assertEqual([(0, ['n0']), (60, ['n1', 'n2'])], refreshed)
+        self.assertEqual([(0, 'a'), (0, 'b'), (60, 'a'), (60, 'b')],
+                         deployed)
+        self.assertEqual([(0, 'nagios4'), (60, 'nagios-b'), (60, 'nagios4')],
+                         reloaded)
+        self.assertEqual([2, 0], [c.refreshed for t, c in configs])
+
+
+class TestCustomHostGroups(unittest.TestCase):
+
+    def test_hostgroups(self):
+        from external_naginator import CustomNagiosHostGroup
+        nodefacts = {
+            'a': {'os': 'Ubuntu', 'release': {'major': '20.04'}},
+            'b': {'os': 'Ubuntu', 'release': {'major': '22.04'}},
+            'c': {'os': 'Debian', 'release': {'major': '11'}},
+            'd': {'os': 'Ubuntu'},
+        }
+        db = PuppetDB({})
+        db.resources = lambda type_, title: iter([Resource('nova',
+                                                           node='b')])
+        hostgroups = {
+            'hostgroup_os-{os}-{release[major]}': [
+                ('fact_template', '{os}'),
+                ('name', '{os} {release[major]}')],
+            'hostgroup_nova-compute-{os}': [
+                ('name', 'Nova Compute {os}'),
+                ('service', 'nova-compute')],
+        }
+        groups = CustomNagiosHostGroup(
+            db, None, hostgroups,
+            nodefacts=nodefacts,
+            nodes=[Node(n) for n in sorted(nodefacts)],
+            nagios_hosts=dict((n, []) for n in nodefacts))
+        objects = list(groups.iter_objects())
+
+        self.assertEqual(
+            [[('hostgroup_name', 'os-Ubuntu-20.04'),
+              ('alias', 'Ubuntu 20.04'),
+              ('members', 'a')],
+             [('hostgroup_name', 'os-Ubuntu-22.04'),
+              ('alias', 'Ubuntu 22.04'),
+              ('members', 'b')],
+             [('hostgroup_name', 'os-Debian-11'),
+              ('alias', 'Debian 11'),
+              ('members', 'c')],
+             [('hostgroup_name', 'nova-compute-Ubuntu'),
+              ('alias', 'Nova Compute Ubuntu'),
+              ('members', 'b')]],
+            [o.directives for o in objects])
+        self.assertEqual({'hostgroup_os-{os}-{release[major]}': ['d'],
+                          'hostgroup_nova-compute-{os}': []},
+                         groups.missing)
+
+    def test_shared_index(self):
+        from external_naginator import CustomNagiosHostGroup
+        nodefacts = {'a': {'os': 'Ubuntu', 'site': 'mel'},
+                     'b': {'os': 'Debian', 'site': 'mel'},
+                     'c': {'os': 'Ubuntu'}}
+        hostgroups = {
+            'hostgroup_os-{os}-{site}': [],
+            'hostgroup_{site}-{os}': [('name', '{os} at {site}')],
+            'hostgroup_os-{os}': [],
+        }
+        groups = CustomNagiosHostGroup(
+            PuppetDB({}), None, hostgroups,
+            nodefacts=nodefacts,
+            nodes=[Node(n) for n in sorted(nodefacts)],
+            nagios_hosts=dict((n, []) for n in nodefacts))
+        with mock.patch.object(groups, 'index_hosts',
+                               wraps=groups.index_hosts) as index_hosts:
+            objects = dict((o.name, dict(o.directives))
+                           for o in groups.iter_objects())
+
+        # The sections using os and site share one index.
+        self.assertEqual(2, index_hosts.call_count)
+        self.assertEqual({'os-Ubuntu-mel': 'a', 'os-Debian-mel': 'b',
+                          'mel-Ubuntu': 'a', 'mel-Debian': 'b',
+                          'os-Ubuntu': 'a,c', 'os-Debian': 'b'},
+                         dict((n, d['members']) for n, d in objects.items()))
+        self.assertEqual('Debian at mel', objects['mel-Debian']['alias'])
+        self.assertEqual({'hostgroup_os-{os}-{site}': ['c'],
+                          'hostgroup_{site}-{os}': ['c'],
+                          'hostgroup_os-{os}': []},
+                         groups.missing)
+
+
+class TestStaleOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.fallback_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fallback_dir)
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def write(self, directory, contents):
+        for filename, text in contents.items():
+            with open(os.path.join(directory, filename), 'w') as f:
+                f.write(text)
+
+    def read(self, directory):
+        contents = {}
+        for filename in os.listdir(directory):
+            with open(os.path.join(directory, filename)) as f:
+                contents[filename] = f.read()
+        return contents
+
+    def nagios_config(self, resources, **kwargs):
+        from external_naginator import NagiosConfig
+        db = PuppetDB(resources, [Node('web1')])
+        db.timeout = 30
+        config = NagiosConfig(None, None, None, db=db, **kwargs)
+        config.output_dir = self.output_dir
+        return config
+
+    def test_reuse_config(self):
+        from external_naginator import reuse_config
+        self.write(self.fallback_dir, {'host_web1.cfg': 'old web1',
+                                       'auto_command.cfg': 'old command'})
+        self.write(self.output_dir, {'host_web1.cfg': 'new web1',
+                                     'host_web2.cfg': 'new web2',
+                                     'auto_command.cfg': 'new command'})
+        reuse_config(self.fallback_dir, self.output_dir, ['host_*.cfg'])
+
+        self.assertEqual({'host_web1.cfg': 'old web1',
+                          'auto_command.cfg': 'new command'},
+                         self.read(self.output_dir))
+
+    def test_generate_stage(self):
+        config = self.nagios_config({})
+        self.write(self.fallback_dir, {'auto_command.cfg': 'old'})
+        timeouts = []
+
+        def generate():
+            timeouts.append(config.db.timeout)
+            self.write(self.output_dir, {'auto_command.cfg': 'new'})
+
+        # The requests get no longer than is left before the deadline.
+        config.generate_stage('NagiosCommand', generate,
+                              ['auto_command.cfg'],
+                              deadline=time.monotonic() + 5,
+                              fallback_dir=self.fallback_dir)
+        self.assertTrue(0 < timeouts[0] <= 5)
+        self.assertEqual(30, config.db.timeout)
+        self.assertEqual({'auto_command.cfg': 'new'},
+                         self.read(self.output_dir))
+        self.assertEqual([], config.stale)
+
+        config.generate_stage('NagiosCommand', generate,
+                              ['auto_command.cfg'],
+                              deadline=time.monotonic() - 1,
+                              fallback_dir=self.fallback_dir)
+        self.assertEqual(1, len(timeouts))
+        self.assertEqual({'auto_command.cfg': 'old'},
+                         self.read(self.output_dir))
+        self.assertEqual(['NagiosCommand'], config.stale)
+
+    def test_generate_stage_fails(self):
+        config = self.nagios_config({})
+        self.write(self.fallback_dir, {'auto_command.cfg': 'old'})
+
+        def generate():
+            self.write(self.output_dir, {'auto_command.cfg': 'partial'})
+            raise RequestException("timed out")
+
+        config.generate_stage('NagiosCommand', generate,
+                              ['auto_command.cfg'],
+                              deadline=time.monotonic() + 5,
+                              fallback_dir=self.fallback_dir)
+        self.assertEqual(30, config.db.timeout)
+        self.assertEqual({'auto_command.cfg': 'old'},
+                         self.read(self.output_dir))
+        self.assertEqual(['NagiosCommand'], config.stale)
+
+        # Without a fallback the failure is raised.
+        self.assertRaises(RequestException, config.generate_stage,
+                          'NagiosCommand', generate, ['auto_command.cfg'])
+
+    def test_stage_deadlines(self):
+        from external_naginator import NagiosType
+        config = self.nagios_config({
+            'Nagios_host': [Resource('web1', address='10.0.0.1')]})
+        config.db.timeout = None
+        now = [0]
+        timeouts = {}
+        resources = config.db.resources
+
+        def slow_resources(query=None, **kwargs):
+            type_ = json.loads(query)[-1]
+            timeouts[type_] = config.db.timeout
+            if type_ == 'Nagios_command':
+                # Uses all of its time
+                now[0] += config.db.timeout
+                raise RequestException("timed out")
+            return resources(query=query, **kwargs)
+
+        config.db.resources = slow_resources
+        included = ['NagiosCommand', 'NagiosContact', 'NagiosHost']
+        excluded = [cls.__name__ for cls in NagiosType.__subclasses__()
+                    if cls.__name__ not in included]
+        with mock.patch('time.monotonic', lambda: now[0]):
+            config.generate_all(excluded_classes=excluded, deadline=70,
+                                fallback_dir=self.fallback_dir)
+
+        # The slow type only gets its share, the time the others don't
+        # use goes to the hosts.
+        self.assertEqual({'Nagios_command': 10, 'Nagios_contact': 10,
+                          'Nagios_host': 60}, timeouts)
+        self.assertEqual(['NagiosCommand'], config.stale)
+        self.assertIn('host_web1.cfg', os.listdir(self.output_dir))
+
+    def test_stale_host_objects(self):
+        config = self.nagios_config({
+            'Nagios_host': [Resource('web1', address='10.0.0.1')],
+            'Nagios_hostgroup': [Resource('web', type_='Nagios_hostgroup',
+                                          members='web1')],
+            'Nagios_hostescalation': RequestException("timed out"),
+            'Nagios_command': [Resource('check_ping', type_='Nagios_command',
+                                        command_line='ping')],
+        })
+        old = {'host_web1.cfg': 'old web1',
+               'auto_host.cfg': '',
+               'auto_hostgroup.cfg': 'old hostgroup',
+               'auto_hostgroup_web.cfg': 'old custom hostgroup',
+               'auto_hostescalation.cfg': 'old hostescalation',
+               'auto_command.cfg': 'old command'}
+        self.write(self.fallback_dir, old)
+
+        included = ['NagiosHost', 'NagiosHostGroup', 'NagiosHostEscalation',
+                    'NagiosCommand']
+        from external_naginator import NagiosType
+        excluded = [cls.__name__ for cls in NagiosType.__subclasses__()
+                    if cls.__name__ not in included]
+        kwargs = dict(deadline=time.monotonic() + 5,
+                      fallback_dir=self.fallback_dir)
+        config.generate_all(excluded_classes=excluded, **kwargs)
+        config.generate_hostgroups(
+            {'hostgroup_web': [('name', 'Web'), ('service', 'nginx')]},
+            **kwargs)
+
+        # Only the types that don't refer to the hosts are new.
+        output = self.read(self.output_dir)
+        self.assertIn('check_ping', output.pop('auto_command.cfg'))
+        del old['auto_command.cfg']
+        self.assertEqual(old, output)
+        self.assertEqual(['NagiosHostEscalation', 'NagiosHost',
+                          'NagiosHostGroup', 'CustomNagiosHostGroup'],
+                         config.stale)
+
+    def test_stale_servicegroups_on_services(self):
+        config = self.nagios_config({
+            'Nagios_host': [Resource('web1', address='10.0.0.1')],
+            'Nagios_service': [Resource('http-web1', type_='Nagios_service',
+                                        host_name='web1',
+                                        service_description='http')],
+            'Nagios_hostescalation': RequestException("timed out"),
+        }, auto_servicegroups='services')
+        old = {'host_web1.cfg': 'old web1',
+               'auto_servicegroup_ssh.cfg': 'old ssh'}
+        self.write(self.fallback_dir, old)
+
+        included = ['NagiosHost', 'NagiosService', 'NagiosAutoServiceGroup',
+                    'NagiosHostEscalation']
+        from external_naginator import NagiosType
+        excluded = [cls.__name__ for cls in NagiosType.__subclasses__()
+                    if cls.__name__ not in included]
+        config.generate_all(excluded_classes=excluded,
+                            deadline=time.monotonic() + 5,
+                            fallback_dir=self.fallback_dir)
+
+        # The reused services are members of the old servicegroups.
+        output = self.read(self.output_dir)
+        self.assertEqual(old, dict((f, output[f]) for f in output
+                                   if f.startswith(('host_',
+                                                    'auto_servicegroup_'))))
+        self.assertIn('NagiosAutoServiceGroup', config.stale)
+
+
 if __name__ == '__main__':
     unittest.main()